@@ -1,13 +1,83 @@
+import asyncio
+import heapq
+import math
+import operator
+import string
+import sys
+import uuid
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Tuple, Callable
+from array import array
+from collections import ChainMap, Counter, defaultdict, deque
+from itertools import compress, repeat
+from typing import Any, AsyncIterator, Dict, FrozenSet, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple, Callable
+
+try:
+    import orjson # Optional: faster serialization of LLM context payloads.
+except ImportError:
+    orjson = None
+    import json
+
+
+def json_dumps(obj: Any) -> str:
+    """Serializes obj to a JSON string, using orjson when installed. Unknown types are stringified."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode()
+    return json.dumps(obj, default=str)
+
+
+def json_loads(text: str) -> Any:
+    """Parses a JSON document, using orjson when installed. Raises ValueError on malformed input."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
 
 # --- Core Data Structures ---
 
+# Comparison op codes for compiled conditions, dispatched through CONDITION_OPS by index.
+COND_EQ, COND_NE, COND_GT, COND_GE, COND_LT, COND_LE = range(6)
+CONDITION_OPS: Tuple[Callable[[Any, Any], bool], ...] = (
+    operator.eq, operator.ne, operator.gt, operator.ge, operator.lt, operator.le
+)
+
+# A condition compiled against a GameState's variable slots: (op_code, variable_slot, compare_value).
+CompiledCondition = Tuple[int, int, Any]
+
+# Fills a slot that was allocated (e.g. by compile_condition) before its variable was ever set.
+# Distinct from None so that variables explicitly set to None stay visible.
+_UNSET_SLOT = object()
+
+
+def eval_compiled_condition(compiled: CompiledCondition, values: Sequence[Any]) -> bool:
+    """
+    Evaluates one compiled condition against slot storage. _UNSET_SLOT compares as None, and
+    ordering comparisons against unset (None) variables fail.
+    """
+    op_code, variable_slot, compare_value = compiled
+    value = values[variable_slot]
+    if value is _UNSET_SLOT:
+        value = None
+    try:
+        return CONDITION_OPS[op_code](value, compare_value)
+    except TypeError:
+        return False
+
 class GameState(ABC):
     """
     Abstract base class for representing the current state of the game.
     This includes player inventory, character statuses, world flags, etc.
+    Change tracking is set up on first use, so subclasses need not call super().__init__().
     """
+    # True if set_variable reports every change through _notify_variable_changed, which makes
+    # get_version() a valid cache key. Version-keyed caches are bypassed for states that leave it False.
+    notifies_changes: bool = False
+
+    def __init__(self):
+        self._init_change_tracking()
+
+    def _init_change_tracking(self) -> None:
+        self._change_listeners: List[Callable[[str, Any, Any], None]] = []
+        self._version = 0 # Bumped on every variable change.
+        self._var_version: Dict[str, int] = {} # variable_name -> _version at its last change
 
     @abstractmethod
     def get_variable(self, variable_name: str) -> Any:
@@ -16,9 +86,39 @@ class GameState(ABC):
 
     @abstractmethod
     def set_variable(self, variable_name: str, value: Any) -> None:
-        """Sets the value of a game state variable."""
+        """
+        Sets the value of a game state variable.
+        Implementations should call _notify_variable_changed so indexes over the state stay current,
+        and then set notifies_changes.
+        """
         pass
 
+    def add_change_listener(self, listener: Callable[[str, Any, Any], None]) -> None:
+        """Registers a callback invoked as listener(variable_name, old_value, new_value) on every change."""
+        if not hasattr(self, "_change_listeners"):
+            self._init_change_tracking()
+        self._change_listeners.append(listener)
+
+    def get_version(self, variable_names: Optional[Iterable[str]] = None) -> int:
+        """
+        Returns a counter that changes whenever any of the given variables (or, if None,
+        any variable at all) changes. Useful as a cache key for state-derived results.
+        """
+        if not hasattr(self, "_change_listeners"):
+            self._init_change_tracking()
+        if variable_names is None:
+            return self._version
+        var_version = self._var_version
+        return max((var_version.get(name, 0) for name in variable_names), default=0)
+
+    def _notify_variable_changed(self, variable_name: str, old_value: Any, new_value: Any) -> None:
+        if not hasattr(self, "_change_listeners"):
+            self._init_change_tracking()
+        self._version += 1
+        self._var_version[variable_name] = self._version
+        for listener in self._change_listeners:
+            listener(variable_name, old_value, new_value)
+
     @abstractmethod
     def check_condition(self, condition: Dict[str, Any]) -> bool:
         """
@@ -27,6 +127,30 @@ class GameState(ABC):
         """
         pass
 
+    def index_condition(self, condition: Dict[str, Any]) -> Optional[Tuple[str, Any]]:
+        """
+        Returns (variable_name, expected_value) if the condition is a plain equality test,
+        allowing it to be served from a PreconditionIndex. Returns None for anything else,
+        which is then evaluated through check_condition.
+        """
+        return None
+
+    def compile_condition(self, condition: Dict[str, Any]) -> Optional[CompiledCondition]:
+        """
+        Compiles a condition to (op_code, variable_slot, compare_value), where variable_slot indexes
+        the sequence returned by variable_values(). States that keep their variables in flat
+        slot storage implement this so conditions can be evaluated in batches by
+        find_failing_conditions. Returns None if the condition cannot be compiled.
+        """
+        return None
+
+    def variable_values(self) -> Sequence[Any]:
+        """
+        Returns the slot-indexed variable storage referenced by compiled conditions.
+        Override together with compile_condition; the default has no slots.
+        """
+        return ()
+
     @abstractmethod
     def apply_effect(self, effect: Dict[str, Any]) -> None:
         """
@@ -35,11 +159,27 @@ class GameState(ABC):
         """
         pass
 
+    def apply_effects_batch(self, effects: Sequence[Dict[str, Any]]) -> None:
+        """
+        Applies several effects in order. States whose effects are plain assignments can override
+        this to merge the effects and write each variable once.
+        """
+        apply = self.apply_effect
+        for effect in effects:
+            apply(effect)
+
     @abstractmethod
     def get_context_for_llm(self) -> Dict[str, Any]:
         """Returns a dictionary representing the current game state relevant for LLM prompting."""
         pass
 
+    def variables_view(self) -> Mapping[str, Any]:
+        """
+        Returns a read-only name -> value mapping of the set variables, e.g. for str.format_map.
+        States with their own storage can return a live view instead; the default is get_context_for_llm().
+        """
+        return self.get_context_for_llm()
+
 class LLMInterface(ABC):
     """
     Abstract base class for interacting with a Large Language Model.
@@ -48,16 +188,43 @@ class LLMInterface(ABC):
     @abstractmethod
     async def generate_text(
         self,
-        prompt: str,
+        system: str, # Stable instructions, e.g. engine-wide narrative rules
+        user: str, # Volatile, per-call request
         context: Dict[str, Any], # GameState context + storylet-specific context
         constraints: List['NarrativeConstraint'], # LLM-specific generation constraints
         max_tokens: Optional[int] = None,
         temperature: Optional[float] = None,
+        guidance: Optional[str] = None, # Joined constraint guidance, if the caller precomputed it
         # Other LLM parameters as needed
     ) -> str:
-        """Generates text based on a prompt, context, and constraints."""
+        """
+        Generates text based on a system prompt, a user prompt, context, and constraints.
+        The system prompt and constraint guidance form the leading block of the request and the
+        user prompt and context follow, so callers should keep system identical across calls:
+        provider-side prompt caching can then skip prefill of the shared prefix (for Anthropic,
+        mark the system block with cache_control={"type": "ephemeral"}).
+        When guidance is given (e.g. from NarrativeEngine.get_constraint_guidance()), it is used
+        as is instead of joining get_llm_guidance() over constraints.
+        """
         pass
 
+    async def stream_text(
+        self,
+        system: str,
+        user: str,
+        context: Dict[str, Any],
+        constraints: List['NarrativeConstraint'],
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        guidance: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Streams generated text as it is decoded, e.g. via stream=True (OpenAI) or
+        client.messages.stream (Anthropic). Closing the iterator early should abort the
+        provider request. The default yields the complete generate_text result as one chunk.
+        """
+        yield await self.generate_text(system, user, context, constraints, max_tokens, temperature, guidance)
+
     @abstractmethod
     async def generate_storylet_weights(
         self,
@@ -72,15 +239,256 @@ class LLMInterface(ABC):
         """
         pass
 
+class LLMRequest(NamedTuple):
+    """A single queued generate_text call awaiting dispatch by a BatchingLLMInterface."""
+    system: str
+    user: str
+    context: Dict[str, Any]
+    constraints: List['NarrativeConstraint']
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    # Ask for a JSON object reply, e.g. response_format={"type": "json_object"} (OpenAI)
+    # or a forced tool-use schema (Anthropic).
+    json_mode: bool = False
+    guidance: Optional[str] = None # Precomputed constraint guidance; joined from constraints if None
+
+    def context_json(self) -> str:
+        """Serializes the request context for inclusion in a provider message."""
+        return json_dumps(self.context)
+
+    def messages(self) -> List[Dict[str, str]]:
+        """
+        Chat messages for this request: a system block holding the stable instructions and
+        constraint guidance, then a user turn with the volatile prompt and serialized context.
+        Anthropic adapters pass messages()[0]["content"] as the separate system parameter with
+        cache_control={"type": "ephemeral"}.
+        """
+        guidance = self.guidance
+        if guidance is None:
+            guidance = "\n".join(text for text in (c.get_llm_guidance() for c in self.constraints) if text)
+        system = f"{self.system}\n{guidance}" if guidance else self.system
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": f"{self.user}\n\nGame state: {self.context_json()}"},
+        ]
+
+
+class BatchingLLMInterface(LLMInterface):
+    """
+    LLMInterface that micro-batches generate_text calls.
+    Requests are queued and dispatched together once max_batch_size of them are
+    waiting or max_wait_ms has passed since the first one arrived, so N concurrent
+    callers cost roughly N / max_batch_size provider round-trips instead of N.
+    Concrete subclasses wrap a provider client (e.g. AsyncOpenAI or AsyncAnthropic)
+    and implement _dispatch_batch.
+    """
+    ranking_max_tokens: int = 4096 # Completion budget for the single storylet-ranking prompt
+    ranking_system_prompt: str = (
+        "You rate how well candidate storylets fit the current state of an interactive narrative, "
+        "from 0.0 (does not fit) to 1.0 (fits perfectly)."
+    )
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 25.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue: Optional[asyncio.Queue] = None
+        self._results: Dict[str, asyncio.Future] = {} # request uuid -> caller's future
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+
+    @abstractmethod
+    async def _dispatch_batch(self, requests: List[LLMRequest]) -> List[str]:
+        """
+        Sends a batch of requests to the provider in as few calls as possible and returns
+        the completions in the same order, e.g. asyncio.gather over
+        client.chat.completions.create, or one Anthropic message-batches submission.
+        """
+        pass
+
+    async def generate_text(
+        self,
+        system: str,
+        user: str,
+        context: Dict[str, Any],
+        constraints: List['NarrativeConstraint'],
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        guidance: Optional[str] = None,
+        json_mode: bool = False
+    ) -> str:
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._results[request_id] = future
+        self._ensure_worker()
+        self._queue.put_nowait(
+            (request_id, LLMRequest(system, user, context, constraints, max_tokens, temperature, json_mode, guidance))
+        )
+        try:
+            return await future
+        finally:
+            self._results.pop(request_id, None)
+
+    async def generate_storylet_weights(
+        self,
+        current_game_state: GameState,
+        candidate_storylets: List['SmartStorylet'],
+        narrative_context: Dict[str, Any],
+        active_constraints: List['NarrativeConstraint']
+    ) -> Dict[str, float]:
+        """
+        Ranks all candidates with one prompt that asks for a JSON {storylet_id: weight} object,
+        so the shared narrative context is sent once. Candidates missing from the reply are
+        scored individually.
+        """
+        if not candidate_storylets:
+            return {}
+        context = dict(current_game_state.get_context_for_llm(), **narrative_context)
+        candidates = "\n".join(
+            f"- [{s.get_id()}] {s.get_metadata().get('summary', s.get_metadata())}" for s in candidate_storylets
+        )
+        reply = await self.generate_text(
+            self.ranking_system_prompt,
+            "Rate each candidate storylet. Reply with a JSON object mapping each bracketed storylet id "
+            "to its weight.\n" + candidates,
+            context, active_constraints, max_tokens=self.ranking_max_tokens, temperature=0.0, json_mode=True
+        )
+        weights = _parse_weight_map(reply, [s.get_id() for s in candidate_storylets])
+        missing = [s for s in candidate_storylets if s.get_id() not in weights]
+        if missing:
+            weights.update(await self._score_individually(missing, context, active_constraints))
+        return weights
+
+    async def _score_individually(
+        self,
+        storylets: List['SmartStorylet'],
+        context: Dict[str, Any],
+        active_constraints: List['NarrativeConstraint']
+    ) -> Dict[str, float]:
+        """Scores storylets one prompt each; the prompts are issued concurrently so they share a batch."""
+        replies = await asyncio.gather(*[
+            self.generate_text(
+                self.ranking_system_prompt,
+                f"Rate storylet '{s.get_id()}' ({s.get_metadata()}). Reply with the number only.",
+                context, active_constraints, max_tokens=8, temperature=0.0
+            )
+            for s in storylets
+        ])
+        return {s.get_id(): _parse_weight(reply) for s, reply in zip(storylets, replies)}
+
+    async def aclose(self) -> None:
+        """Stops the background batching task. Requests still queued are cancelled."""
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        for future in self._results.values():
+            future.cancel()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._collect_batches())
+
+    async def _collect_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000.0
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch in the background so the next batch can fill while this one is in flight.
+            task = loop.create_task(self._resolve_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _resolve_batch(self, batch: List[Tuple[str, LLMRequest]]) -> None:
+        try:
+            completions = await self._dispatch_batch([request for _, request in batch])
+            if len(completions) != len(batch):
+                raise ValueError(f"Provider returned {len(completions)} completions for {len(batch)} requests")
+        except Exception as e:
+            for request_id, _ in batch:
+                future = self._results.get(request_id)
+                if future and not future.done():
+                    future.set_exception(e)
+            return
+        for (request_id, _), completion in zip(batch, completions):
+            future = self._results.get(request_id)
+            if future and not future.done():
+                future.set_result(completion)
+
+
+def _parse_weight(reply: Any) -> float:
+    """Parses an LLM-produced weight, clamped to [0, 1]; unparseable replies weigh 0."""
+    try:
+        return min(1.0, max(0.0, float(reply)))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _parse_weight_map(reply: str, storylet_ids: List[str]) -> Dict[str, float]:
+    """
+    Extracts clamped weights for the given ids from a JSON object reply.
+    Ids that are absent or have non-numeric weights are left out.
+    """
+    try:
+        parsed = json_loads(reply)
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    weights = {}
+    for storylet_id in storylet_ids:
+        value = parsed.get(storylet_id)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            weights[storylet_id] = min(1.0, max(0.0, float(value)))
+    return weights
+
 # --- Narrative Components ---
 
-class SmartStorylet(ABC):
+class _SlotDefaults:
+    """
+    Fills slots that __init__ would have set when a subclass skips super().__init__(): on first
+    read, an unset name listed in _slot_defaults is assigned a value from its factory.
+    Initialized instances never reach __getattr__, so this costs nothing on the normal path.
+    """
+    __slots__ = ()
+    _slot_defaults: Dict[str, Callable[[], Any]] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        factory = type(self)._slot_defaults.get(name)
+        if factory is None:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        value = factory()
+        setattr(self, name, value)
+        return value
+
+
+class SmartStorylet(_SlotDefaults, ABC):
     """
     Abstract base class for a self-contained narrative unit.
+    Narrative classes declare __slots__ to keep large projects compact; subclasses should too.
     """
+    __slots__ = ("storylet_id", "author_tags", "_preconds_tuple", "_effects_tuple", "_preconds_compiled")
+    _slot_defaults = {
+        "author_tags": list, "_preconds_tuple": lambda: None, "_effects_tuple": lambda: None,
+        "_preconds_compiled": lambda: None,
+    }
+
     def __init__(self, storylet_id: str, author_tags: Optional[List[str]] = None):
         self.storylet_id = storylet_id
         self.author_tags = author_tags if author_tags else [] # For organization, theme, etc.
+        # Snapshots of get_preconditions()/get_effects(), taken on first use.
+        self._preconds_tuple: Optional[Tuple[Dict[str, Any], ...]] = None
+        self._effects_tuple: Optional[Tuple[Dict[str, Any], ...]] = None
+        # (game_state, compiled preconditions) set by the engine at registration, if all of them compile.
+        # Slots are specific to that state; any other state goes through check_condition.
+        self._preconds_compiled: Optional[Tuple[GameState, Tuple[CompiledCondition, ...]]] = None
 
     @abstractmethod
     def get_id(self) -> str:
@@ -98,10 +506,15 @@ class SmartStorylet(ABC):
     @abstractmethod
     def check_preconditions(self, game_state: GameState) -> bool:
         """Checks if all preconditions are met by the current game state."""
-        for condition in self.get_preconditions():
-            if not game_state.check_condition(condition):
-                return False
-        return True
+        compiled = self._preconds_compiled
+        if compiled is not None and compiled[0] is game_state:
+            values = game_state.variable_values()
+            return all(eval_compiled_condition(condition, values) for condition in compiled[1])
+        preconds = self._preconds_tuple
+        if preconds is None:
+            preconds = self._preconds_tuple = tuple(self.get_preconditions())
+        check = game_state.check_condition
+        return all(check(condition) for condition in preconds)
 
     @abstractmethod
     def get_effects(self) -> List[Dict[str, Any]]:
@@ -114,27 +527,47 @@ class SmartStorylet(ABC):
     @abstractmethod
     def apply_effects(self, game_state: GameState) -> None:
         """Applies the storylet's effects to the game state."""
-        for effect in self.get_effects():
-            game_state.apply_effect(effect)
+        effects = self._effects_tuple
+        if effects is None:
+            effects = self._effects_tuple = tuple(self.get_effects())
+        game_state.apply_effects_batch(effects)
 
     @abstractmethod
     async def generate_content(
         self,
         game_state: GameState,
         llm_interface: Optional[LLMInterface] = None,
-        active_constraints: Optional[List['NarrativeConstraint']] = None
+        active_constraints: Optional[List['NarrativeConstraint']] = None,
+        guidance: Optional[str] = None
     ) -> str:
         """
         Generates or retrieves the content of this storylet.
         This might involve authored text, LLM generation, or a combination.
+        guidance is the active constraints' joined LLM guidance, to be forwarded to generate_text.
         """
         pass
 
+    async def stream_content(
+        self,
+        game_state: GameState,
+        llm_interface: Optional[LLMInterface] = None,
+        active_constraints: Optional[List['NarrativeConstraint']] = None,
+        guidance: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Streams the content of this storylet in chunks as it becomes available, so callers can
+        present the first tokens before generation finishes. The default yields the complete
+        generate_content result as one chunk.
+        """
+        yield await self.generate_content(game_state, llm_interface, active_constraints, guidance)
+
     @abstractmethod
     def get_llm_directives(self) -> Optional[Dict[str, Any]]:
         """
         Returns specific directives for LLM generation if this storylet uses an LLM.
-        e.g., {"prompt_template": "Character A says to B: {dialogue_topic}", "tone": "suspicious"}
+        e.g., {"system_template": "You voice characters in a noir mystery.",
+               "user_template": "Character A says to B: {dialogue_topic}", "tone": "suspicious"}
+        Keep system_template shared across storylets so it stays a cacheable prompt prefix.
         """
         pass
 
@@ -149,29 +582,80 @@ class SmartStorylet(ABC):
         pass
 
 
-class NarrativeConstraint(ABC):
+GLOBAL_SCOPE = "global"
+FLOW_NODE_SCOPE_PREFIX = "local_to_flow_node_" # Followed by the node_id the constraint is limited to
+
+
+class NarrativeConstraint(_SlotDefaults, ABC):
     """
     Abstract base class for a narrative constraint.
     Constraints can influence storylet selection or LLM generation.
     """
-    def __init__(self, constraint_id: str, description: str, scope: str = "global"):
+    __slots__ = (
+        "constraint_id", "description", "scope", "weight", "max_score", "expensive", "dependencies", "_eval_cache"
+    )
+    _slot_defaults = {
+        "scope": lambda: GLOBAL_SCOPE, "weight": lambda: 1.0, "max_score": lambda: None, "expensive": lambda: False,
+        "dependencies": lambda: None, "_eval_cache": dict,
+    }
+
+    def __init__(
+        self,
+        constraint_id: str,
+        description: str,
+        scope: str = "global",
+        dependencies: Optional[Iterable[str]] = None,
+        weight: float = 1.0,
+        max_score: Optional[float] = None,
+        expensive: bool = False
+    ):
         self.constraint_id = constraint_id
         self.description = description
         self.scope = scope # e.g., "global", "local_to_flow_node_X", "character_Y"
+        self.weight = weight # Multiplier applied to evaluate() scores during storylet selection
+        self.max_score = max_score # Upper bound of evaluate(), if known; lets selection prune candidates early
+        self.expensive = expensive # e.g. LLM-backed; evaluated after cheap constraints had a chance to prune
+        # Game state variables evaluate() reads; None means it may depend on any of them.
+        self.dependencies: Optional[FrozenSet[str]] = frozenset(dependencies) if dependencies is not None else None
+        self._eval_cache: Dict[Optional[str], Tuple[GameState, int, float]] = {} # storylet_id -> (state, version, score)
 
     @abstractmethod
     def get_id(self) -> str:
         return self.constraint_id
 
     @abstractmethod
-    def evaluate(self, game_state: GameState, candidate_storylet: Optional[SmartStorylet] = None) -> float:
+    async def evaluate(self, game_state: GameState, candidate_storylet: Optional[SmartStorylet] = None) -> float:
         """
         Evaluates how well the current state or a candidate storylet satisfies this constraint.
         Returns a score (e.g., 0.0 to 1.0, or a penalty/bonus).
         If candidate_storylet is None, evaluates the constraint against the general game state.
+        Asynchronous so remote (e.g. LLM-backed) constraints can be evaluated concurrently.
         """
         pass
 
+    def optimistic_contribution(self) -> float:
+        """Largest weighted score this constraint can add during selection; infinite if unbounded."""
+        if self.max_score is None or self.weight < 0:
+            return math.inf
+        return self.weight * self.max_score
+
+    async def evaluate_cached(self, game_state: GameState, candidate_storylet: Optional[SmartStorylet] = None) -> float:
+        """
+        Memoized evaluate(). A cached score is reused for the same game state until one of the
+        constraint's dependencies changes in it; stale entries are replaced lazily on the next read.
+        States that do not set notifies_changes are always evaluated afresh.
+        """
+        if not game_state.notifies_changes:
+            return await self.evaluate(game_state, candidate_storylet)
+        storylet_id = candidate_storylet.get_id() if candidate_storylet is not None else None
+        version = game_state.get_version(self.dependencies)
+        cached = self._eval_cache.get(storylet_id)
+        if cached is not None and cached[0] is game_state and cached[1] == version:
+            return cached[2]
+        score = await self.evaluate(game_state, candidate_storylet)
+        self._eval_cache[storylet_id] = (game_state, version, score)
+        return score
+
     @abstractmethod
     def get_llm_guidance(self) -> Optional[str]:
         """
@@ -186,6 +670,8 @@ class NarrativeFlowGraphNode(ABC):
     Abstract base class for a node in the Narrative FlowGraph.
     Nodes can represent individual storylets, clusters, or generative zones.
     """
+    __slots__ = ("node_id", "node_type")
+
     def __init__(self, node_id: str, node_type: str): # e.g., "storylet_cluster", "critical_path_point"
         self.node_id = node_id
         self.node_type = node_type
@@ -219,6 +705,8 @@ class Bark(ABC):
     """
     Abstract base class for a short, reactive piece of dialogue or text.
     """
+    __slots__ = ("bark_id", "trigger_event")
+
     def __init__(self, bark_id: str, trigger_event: str):
         self.bark_id = bark_id
         self.trigger_event = trigger_event # e.g., "player_low_health", "item_pickup_X"
@@ -248,22 +736,220 @@ class Bark(ABC):
         """Returns a specific prompt template for LLM generation if this bark uses an LLM."""
         pass
 
+
+class ConditionColumns(NamedTuple):
+    """Compiled conditions sharing one op code, stored column-wise. owners[i] is the storylet_id of condition i."""
+    owners: List[str]
+    variable_slots: array
+    compare_values: List[Any]
+
+
+def find_failing_conditions(columns: Dict[int, ConditionColumns], values: Sequence[Any]) -> Set[str]:
+    """
+    Evaluates column-stored compiled conditions against slot storage and returns the owners
+    with at least one failing condition.
+    Each op code's column is evaluated as one map pipeline (gather slots, compare, mask owners),
+    so the per-condition work runs in C rather than in a Python-level loop.
+    Comparisons against unset (None) variables count as failed.
+    """
+    failed: Set[str] = set()
+    gather = values.__getitem__
+    for op_code, column in columns.items():
+        gathered = list(map(gather, column.variable_slots))
+        passed = None
+        if not any(map(operator.is_, gathered, repeat(_UNSET_SLOT))):
+            try:
+                passed = list(map(CONDITION_OPS[op_code], gathered, column.compare_values))
+            except TypeError: # An ordering comparison hit an unset variable.
+                pass
+        if passed is None: # Per-condition checks, which also read never-set slots as None.
+            passed = [
+                eval_compiled_condition((op_code, slot, value), values)
+                for slot, value in zip(column.variable_slots, column.compare_values)
+            ]
+        failed.update(compress(column.owners, map(operator.not_, passed)))
+    return failed
+
+
+class PreconditionIndex:
+    """
+    Inverted index from (variable_name, value) to the storylets whose preconditions require it.
+    The index listens to GameState changes and keeps a per-storylet count of satisfied equality
+    preconditions, so finding eligible storylets needs no per-storylet predicate calls.
+    Other conditions are compiled through GameState.compile_condition and evaluated for all
+    storylets at once by find_failing_conditions; anything left is checked with
+    check_condition on the remaining candidates only.
+    """
+    def __init__(self, storylets: List['SmartStorylet'], game_state: GameState):
+        self._storylets: Dict[str, SmartStorylet] = {} # in registration order
+        self._position: Dict[str, int] = {} # storylet_id -> registration position
+        self._index: Dict[Tuple[str, Any], Set[str]] = defaultdict(set)
+        self._required: Dict[str, int] = {} # storylet_id -> number of indexed preconditions
+        self._satisfied: Dict[str, int] = {} # storylet_id -> number of those currently true
+        self._residual: Dict[str, List[Dict[str, Any]]] = {} # storylet_id -> unindexed preconditions
+        self._ready: Set[str] = set() # storylet_ids with every indexed precondition satisfied
+        self._columns: Dict[int, ConditionColumns] = {} # op_code -> compiled preconditions using it
+        for storylet in storylets:
+            self._add_storylet(storylet, game_state)
+        game_state.add_change_listener(self._on_variable_changed)
+
+    def _add_storylet(self, storylet: 'SmartStorylet', game_state: GameState) -> None:
+        storylet_id = storylet.get_id()
+        keys: Set[Tuple[str, Any]] = set()
+        compiled: List[CompiledCondition] = []
+        residual: List[Dict[str, Any]] = []
+        for condition in storylet.get_preconditions():
+            key = game_state.index_condition(condition)
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+            if key is not None:
+                keys.add(key)
+                continue
+            compiled_condition = game_state.compile_condition(condition)
+            if compiled_condition is None:
+                residual.append(condition)
+            else:
+                compiled.append(compiled_condition)
+        for op_code, variable_slot, compare_value in compiled:
+            column = self._columns.get(op_code)
+            if column is None:
+                column = self._columns[op_code] = ConditionColumns([], array('l'), [])
+            column.owners.append(storylet_id)
+            column.variable_slots.append(variable_slot)
+            column.compare_values.append(compare_value)
+        for key in keys:
+            self._index[key].add(storylet_id)
+        self._storylets[storylet_id] = storylet
+        self._position.setdefault(storylet_id, len(self._position))
+        self._required[storylet_id] = len(keys)
+        self._satisfied[storylet_id] = sum(1 for name, value in keys if game_state.get_variable(name) == value)
+        if residual:
+            self._residual[storylet_id] = residual
+        if self._satisfied[storylet_id] == self._required[storylet_id]:
+            self._ready.add(storylet_id)
+
+    def _on_variable_changed(self, variable_name: str, old_value: Any, new_value: Any) -> None:
+        if old_value == new_value:
+            return
+        for storylet_id in self._lookup(variable_name, old_value):
+            self._satisfied[storylet_id] -= 1
+            self._ready.discard(storylet_id)
+        for storylet_id in self._lookup(variable_name, new_value):
+            self._satisfied[storylet_id] += 1
+            if self._satisfied[storylet_id] == self._required[storylet_id]:
+                self._ready.add(storylet_id)
+
+    def _lookup(self, variable_name: str, value: Any) -> Set[str]:
+        try:
+            return self._index.get((variable_name, value), set())
+        except TypeError: # Unhashable values can never appear in the index.
+            return set()
+
+    def eligible_storylets(self, game_state: GameState) -> List['SmartStorylet']:
+        """
+        Returns the storylets whose preconditions all hold in the current game state, in the
+        order they were registered so that tie-breaking downstream is deterministic.
+        """
+        failed_compiled = find_failing_conditions(self._columns, game_state.variable_values()) if self._columns else set()
+        eligible = []
+        for storylet_id in sorted(self._ready, key=self._position.__getitem__):
+            if storylet_id in failed_compiled:
+                continue
+            residual = self._residual.get(storylet_id)
+            if residual and not all(game_state.check_condition(c) for c in residual):
+                continue
+            eligible.append(self._storylets[storylet_id])
+        return eligible
+
+
+class NarrativeHistory:
+    """
+    Bounded record of recently activated storylet IDs, oldest first.
+    Only the last maxlen activations are kept. Membership tests are O(1), and recency() reports a
+    weight that decays geometrically with the number of activations since a storylet last played.
+    """
+    def __init__(self, maxlen: int = 64, decay: float = 0.9):
+        self.decay = decay
+        self._entries: deque = deque(maxlen=maxlen)
+        self._counts: Dict[str, int] = {} # storylet_id -> occurrences within the window
+        self._last_played: Dict[str, int] = {} # storylet_id -> activation number of its latest play
+        self._activations = 0
+
+    def append(self, storylet_id: str) -> None:
+        entries = self._entries
+        if len(entries) == entries.maxlen:
+            if not entries: # maxlen=0 keeps no history
+                return
+            evicted = entries[0] # deque drops it on append below
+            remaining = self._counts[evicted] - 1
+            if remaining:
+                self._counts[evicted] = remaining
+            else:
+                del self._counts[evicted]
+                del self._last_played[evicted]
+        entries.append(storylet_id)
+        self._counts[storylet_id] = self._counts.get(storylet_id, 0) + 1
+        self._last_played[storylet_id] = self._activations
+        self._activations += 1
+
+    def recency(self, storylet_id: str) -> float:
+        """1.0 for the storylet played last, decaying by `decay` per later activation; 0.0 if outside the window."""
+        last_played = self._last_played.get(storylet_id)
+        if last_played is None:
+            return 0.0
+        return self.decay ** (self._activations - 1 - last_played)
+
+    def __contains__(self, storylet_id: object) -> bool:
+        return storylet_id in self._counts
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getitem__(self, index: int) -> str:
+        return self._entries[index]
+
+
+def _iter_bits(mask: int) -> Iterator[int]:
+    """Yields the indices of the set bits in mask, lowest first."""
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
 # --- Orchestration and Selection ---
 
 class StoryletSelector(ABC):
     """
     Abstract base class for selecting the next storylet to activate.
     """
+    history_penalty: float = 1.0 # Score subtracted from a storylet that just played, decaying with recency
 
     @abstractmethod
     def find_eligible_storylets(
         self,
         all_storylets: List[SmartStorylet],
         current_game_state: GameState,
-        current_flow_node: Optional[NarrativeFlowGraphNode] = None
+        current_flow_node: Optional[NarrativeFlowGraphNode] = None,
+        precondition_index: Optional[PreconditionIndex] = None
     ) -> List[SmartStorylet]:
-        """Filters storylets based on hard preconditions and current narrative flow context."""
-        pass
+        """
+        Filters storylets based on hard preconditions and current narrative flow context.
+        When a PreconditionIndex is supplied it replaces the per-storylet precondition checks.
+        """
+        if precondition_index is not None:
+            eligible = precondition_index.eligible_storylets(current_game_state)
+        else:
+            eligible = [s for s in all_storylets if s.check_preconditions(current_game_state)]
+        if current_flow_node is not None:
+            associated = set(current_flow_node.get_associated_storylets())
+            eligible = [s for s in eligible if s.get_id() in associated]
+        return eligible
 
     @abstractmethod
     async def select_next_storylet(
@@ -271,14 +957,104 @@ class StoryletSelector(ABC):
         eligible_storylets: List[SmartStorylet],
         current_game_state: GameState,
         active_constraints: List[NarrativeConstraint],
-        narrative_history: List[str], # List of recently activated storylet IDs
+        narrative_history: NarrativeHistory, # Recently activated storylet IDs
         llm_interface: Optional[LLMInterface] = None # For LLM-assisted weighting
     ) -> Optional[SmartStorylet]:
         """
         Selects the best storylet from the eligible ones based on constraints,
         history (for Markovian influence), and potentially LLM-generated weights.
         """
-        pass
+        # LLM weights can reorder any candidates, so they need the full ranking; otherwise only the best.
+        ranked = await self.rank_storylets(
+            eligible_storylets, current_game_state, active_constraints,
+            top_k=None if llm_interface is not None else 1, narrative_history=narrative_history
+        )
+        if not ranked:
+            return None
+        if llm_interface is not None and len(ranked) > 1:
+            llm_weights = await llm_interface.generate_storylet_weights(
+                current_game_state, [s for _, s in ranked], {"narrative_history": list(narrative_history)},
+                active_constraints
+            )
+            return max(ranked, key=lambda entry: entry[0] + llm_weights.get(entry[1].get_id(), 0.0))[1]
+        return ranked[0][1]
+
+    async def rank_storylets(
+        self,
+        eligible_storylets: List[SmartStorylet],
+        current_game_state: GameState,
+        active_constraints: List[NarrativeConstraint],
+        top_k: Optional[int] = None,
+        narrative_history: Optional[NarrativeHistory] = None
+    ) -> List[Tuple[float, SmartStorylet]]:
+        """
+        Scores storylets by the weighted sum of active constraint evaluations, minus the history
+        penalty if narrative_history is given, best first.
+        Without top_k all storylet x constraint evaluations run concurrently. With top_k the
+        storylets are scored branch-and-bound: a storylet's remaining constraints are skipped as
+        soon as its partial score plus their optimistic contribution cannot reach the current
+        top_k, and expensive constraints only run for storylets that survive the cheap ones.
+        """
+        if not eligible_storylets or (top_k is not None and top_k <= 0):
+            return []
+        base_scores = [0.0] * len(eligible_storylets)
+        if narrative_history is not None and self.history_penalty:
+            recency = narrative_history.recency
+            base_scores = [-self.history_penalty * recency(s.get_id()) for s in eligible_storylets]
+        if top_k is not None:
+            return await self._rank_bounded(eligible_storylets, current_game_state, active_constraints, top_k, base_scores)
+        scores = await asyncio.gather(*[
+            c.evaluate_cached(current_game_state, s) for s in eligible_storylets for c in active_constraints
+        ])
+        weights = [c.weight for c in active_constraints]
+        k = len(weights)
+        ranked = [
+            (base + sum(map(operator.mul, scores[i * k:(i + 1) * k], weights)), storylet)
+            for i, (base, storylet) in enumerate(zip(base_scores, eligible_storylets))
+        ]
+        ranked.sort(key=operator.itemgetter(0), reverse=True)
+        return ranked
+
+    async def _rank_bounded(
+        self,
+        eligible_storylets: List[SmartStorylet],
+        current_game_state: GameState,
+        active_constraints: List[NarrativeConstraint],
+        top_k: int,
+        base_scores: List[float]
+    ) -> List[Tuple[float, SmartStorylet]]:
+        # Cheap constraints first; among those, the widest (or unbounded) score ranges first so the
+        # bound tightens fastest.
+        order = sorted(active_constraints, key=lambda c: (c.expensive, -c.optimistic_contribution()))
+        cheap = [c for c in order if not c.expensive]
+        expensive = order[len(cheap):]
+        expensive_weights = [c.weight for c in expensive]
+        # remaining[j]: optimistic contribution of order[j:].
+        remaining = [0.0] * (len(order) + 1)
+        for j in range(len(order) - 1, -1, -1):
+            remaining[j] = remaining[j + 1] + order[j].optimistic_contribution()
+        # Min-heap of the best top_k so far as (score, -position, storylet); earlier storylets win ties.
+        best: List[Tuple[float, int, SmartStorylet]] = []
+        for position, (score, storylet) in enumerate(zip(base_scores, eligible_storylets)):
+            threshold = best[0][0] if len(best) == top_k else -math.inf
+            pruned = False
+            for j, constraint in enumerate(cheap):
+                if score + remaining[j] <= threshold:
+                    pruned = True
+                    break
+                score += constraint.weight * await constraint.evaluate_cached(current_game_state, storylet)
+            if pruned or score + remaining[len(cheap)] <= threshold:
+                continue
+            if expensive:
+                results = await asyncio.gather(*[c.evaluate_cached(current_game_state, storylet) for c in expensive])
+                score += sum(map(operator.mul, results, expensive_weights))
+            entry = (score, -position, storylet)
+            if len(best) < top_k:
+                heapq.heappush(best, entry)
+            elif entry[:2] > best[0][:2]:
+                heapq.heapreplace(best, entry)
+        best.sort(key=lambda entry: entry[:2], reverse=True)
+        return [(score, storylet) for score, _, storylet in best]
 
 
 class BarkSystem(ABC):
@@ -288,6 +1064,10 @@ class BarkSystem(ABC):
     def __init__(self, all_barks: List[Bark], llm_interface: Optional[LLMInterface] = None):
         self.all_barks = all_barks
         self.llm_interface = llm_interface
+        # Barks grouped by trigger_event so an event only visits the barks it can trigger.
+        self._barks_by_event: Dict[str, List[Bark]] = defaultdict(list)
+        for bark in all_barks:
+            self._barks_by_event[bark.trigger_event].append(bark)
 
     @abstractmethod
     async def process_event(
@@ -299,8 +1079,14 @@ class BarkSystem(ABC):
     ) -> List[str]: # Returns a list of generated bark contents
         """
         Processes a game event and returns any triggered bark content.
+        Content for all triggered barks is generated concurrently.
         """
-        pass
+        tasks = [
+            bark.generate_content(game_state, event_data, self.llm_interface, active_constraints)
+            for bark in self._barks_by_event.get(event_type, ())
+            if bark.check_trigger(event_type, event_data, game_state)
+        ]
+        return list(await asyncio.gather(*tasks))
 
 
 class NarrativeEngine(ABC):
@@ -308,6 +1094,11 @@ class NarrativeEngine(ABC):
     Abstract base class for the main narrative orchestrator.
     Manages game state, storylets, flow graph, constraints, and LLM interaction.
     """
+    # Reorder each node's outgoing transitions by how often they fired, every this many transition
+    # checks. Only enable when a node's transition conditions are mutually exclusive: reordering
+    # changes which transition fires when several hold at once.
+    transition_reorder_interval: Optional[int] = None
+
     def __init__(
         self,
         game_state: GameState,
@@ -316,27 +1107,184 @@ class NarrativeEngine(ABC):
         all_storylets: List[SmartStorylet],
         narrative_flow_graph: Dict[str, NarrativeFlowGraphNode], # node_id -> Node object
         all_constraints: List[NarrativeConstraint],
-        bark_system: Optional[BarkSystem] = None
+        bark_system: Optional[BarkSystem] = None,
+        speculative_prefetch: int = 2, # Front-runners whose content is generated during LLM-assisted selection
+        history_length: int = 64 # Activations kept in narrative_history
     ):
         self.game_state = game_state
         self.llm_interface = llm_interface
         self.storylet_selector = storylet_selector
-        self.all_storylets_map = {s.get_id(): s for s in all_storylets}
+        self.all_storylets = list(all_storylets)
+        # Author-facing string IDs are interned to small ints; internal maps are keyed by the int.
+        self._id_pool: Dict[str, int] = {}
+        # Keyed straight off the id attributes; get_id() would add a method dispatch per element.
+        self.all_storylets_map: Dict[int, SmartStorylet] = dict(
+            zip(map(self._intern, map(operator.attrgetter("storylet_id"), self.all_storylets)), self.all_storylets)
+        )
+        self._compiled_conditions: Dict[Tuple[Tuple[str, Any], ...], CompiledCondition] = {}
+        for storylet in all_storylets:
+            compiled = [self._compile_condition(c) for c in storylet.get_preconditions()]
+            if None not in compiled:
+                storylet._preconds_compiled = (game_state, tuple(compiled))
+        self.precondition_index = PreconditionIndex(all_storylets, game_state)
         self.narrative_flow_graph = narrative_flow_graph
-        self.all_constraints_map = {c.get_id(): c for c in all_constraints}
+        self._flow_nodes: Dict[int, NarrativeFlowGraphNode] = {
+            self._intern(node_id): node for node_id, node in narrative_flow_graph.items()
+        }
+        # Constraint i is bit i; each flow node's active set is precomputed as a mask over those bits.
+        self._constraints_list: List[NarrativeConstraint] = list(all_constraints)
+        self.all_constraints_map: Dict[int, NarrativeConstraint] = dict(
+            zip(map(self._intern, map(operator.attrgetter("constraint_id"), self._constraints_list)), self._constraints_list)
+        )
+        self._global_constraint_mask = 0
+        node_masks: Dict[str, int] = defaultdict(int)
+        for bit, constraint in enumerate(self._constraints_list):
+            if constraint.scope == GLOBAL_SCOPE:
+                self._global_constraint_mask |= 1 << bit
+            elif constraint.scope.startswith(FLOW_NODE_SCOPE_PREFIX):
+                node_masks[constraint.scope[len(FLOW_NODE_SCOPE_PREFIX):]] |= 1 << bit
+        self._node_active_mask: Dict[int, int] = {
+            self._intern(node_id): self._global_constraint_mask | node_masks.get(node_id, 0)
+            for node_id in narrative_flow_graph
+        }
+        # active constraints, as returned by get_active_constraints() -> their joined LLM guidance
+        self._guidance_cache: Dict[Tuple[NarrativeConstraint, ...], str] = {}
         self.bark_system = bark_system
-        self.narrative_history: List[str] = [] # Recently played storylet IDs
+        self.narrative_history = NarrativeHistory(maxlen=history_length) # Recently played storylet IDs
         self.current_flow_node_id: Optional[str] = None # ID of the active node in the flow graph
+        self.speculative_prefetch = speculative_prefetch
+        # node handle -> [(compiled conditions, uncompiled single-entry conditions, target node_id)],
+        # built by initialize_narrative
+        self._transitions: Dict[int, List[Tuple[Tuple[CompiledCondition, ...], Tuple[Dict[str, Any], ...], str]]] = {}
+        self._transition_hits: Counter = Counter() # (node handle, target node_id) -> times fired
+        self._transition_checks = 0
+
+    def _intern(self, name: str) -> int:
+        """Returns the int handle for an author-facing ID, assigning the next free one if new."""
+        handle = self._id_pool.get(name)
+        if handle is None:
+            handle = self._id_pool[name] = len(self._id_pool)
+        return handle
+
+    def _compile_condition(self, condition: Dict[str, Any]) -> Optional[CompiledCondition]:
+        """
+        Compiles a condition against the engine's GameState once, at registration time.
+        Identical conditions share one compiled tuple.
+        """
+        try:
+            key = tuple(condition.items())
+            compiled = self._compiled_conditions.get(key)
+        except TypeError: # Unhashable compare value; compile without sharing.
+            return self.game_state.compile_condition(condition)
+        if compiled is None:
+            compiled = self.game_state.compile_condition(condition)
+            if compiled is not None:
+                self._compiled_conditions[key] = compiled
+        return compiled
+
+    def _compile_transition(
+        self, conditions: Optional[Dict[str, Any]]
+    ) -> Tuple[Tuple[CompiledCondition, ...], Tuple[Dict[str, Any], ...]]:
+        """
+        Splits a transition's conditions into one {key: value} entry each, all of which must hold.
+        Returns the entries that compile and, separately, those left for check_condition.
+        """
+        compiled: List[CompiledCondition] = []
+        residual: List[Dict[str, Any]] = []
+        for key, value in (conditions or {}).items():
+            entry = {key: value}
+            compiled_entry = self._compile_condition(entry)
+            if compiled_entry is None:
+                residual.append(entry)
+            else:
+                compiled.append(compiled_entry)
+        return tuple(compiled), tuple(residual)
 
     @abstractmethod
     def initialize_narrative(self, starting_flow_node_id: str) -> None:
-        """Initializes the narrative, setting the starting point in the flow graph."""
-        pass
+        """
+        Initializes the narrative, setting the starting point in the flow graph.
+        Every node's transition conditions are compiled once here, so the per-tick flow update
+        does not re-read get_connected_nodes(). Raises ValueError if a transition targets a node
+        missing from the flow graph.
+        """
+        transitions: Dict[int, List[Tuple[Tuple[CompiledCondition, ...], Tuple[Dict[str, Any], ...], str]]] = {}
+        for node_id, node in self.narrative_flow_graph.items():
+            node_transitions = transitions[self._intern(node_id)] = []
+            for target_id, conditions in node.get_connected_nodes():
+                if target_id not in self.narrative_flow_graph:
+                    raise ValueError(f"Flow node {node_id!r} has a transition to unknown node {target_id!r}")
+                node_transitions.append((*self._compile_transition(conditions), target_id))
+        self._transitions = transitions
+        self.current_flow_node_id = starting_flow_node_id
+        start_node = self.get_flow_node_by_id(starting_flow_node_id)
+        if start_node is not None:
+            start_node.on_enter(self.game_state, self)
+
+    def _update_flow_position(self) -> None:
+        """Follows the first outgoing transition of the current node whose conditions hold."""
+        if self.current_flow_node_id is None:
+            return
+        handle = self._id_pool.get(self.current_flow_node_id)
+        transitions = self._transitions.get(handle)
+        if not transitions:
+            return
+        values = None
+        check_condition = self.game_state.check_condition
+        for compiled, residual, target_id in transitions:
+            if compiled:
+                if values is None:
+                    values = self.game_state.variable_values()
+                if not all(eval_compiled_condition(c, values) for c in compiled):
+                    continue
+            if residual and not all(map(check_condition, residual)):
+                continue
+            self._transition_hits[handle, target_id] += 1
+            self._move_to_flow_node(target_id)
+            break
+        self._transition_checks += 1
+        if self.transition_reorder_interval and self._transition_checks % self.transition_reorder_interval == 0:
+            hits = self._transition_hits
+            for source, node_transitions in self._transitions.items():
+                node_transitions.sort(key=lambda t: -hits[source, t[2]])
+
+    def _move_to_flow_node(self, node_id: str) -> None:
+        previous_node = self.get_flow_node_by_id(self.current_flow_node_id) if self.current_flow_node_id else None
+        if previous_node is not None:
+            previous_node.on_exit(self.game_state, self)
+        self.current_flow_node_id = node_id
+        next_node = self.get_flow_node_by_id(node_id)
+        if next_node is not None:
+            next_node.on_enter(self.game_state, self)
+
+    def _active_mask(self) -> int:
+        """Bitmask of the constraints active at the current flow node (global-scope ones outside any node)."""
+        handle = self._id_pool.get(self.current_flow_node_id) if self.current_flow_node_id is not None else None
+        return self._node_active_mask.get(handle, self._global_constraint_mask)
 
     @abstractmethod
     def get_active_constraints(self) -> List[NarrativeConstraint]:
-        """Determines which constraints are currently active based on game state and flow graph location."""
-        pass
+        """
+        Determines which constraints are currently active based on game state and flow graph location.
+        The default covers "global" and "local_to_flow_node_<id>" scopes; other scopes are left to subclasses.
+        """
+        constraints = self._constraints_list
+        return [constraints[bit] for bit in _iter_bits(self._active_mask())]
+
+    def get_constraint_guidance(self, active_constraints: Sequence[NarrativeConstraint]) -> str:
+        """
+        Newline-joined LLM guidance of active_constraints (as returned by get_active_constraints(),
+        including any a subclass adds), passed along with storylet content generation.
+        Joined once per distinct active set and then served from a cache keyed by that set.
+        """
+        key = tuple(active_constraints)
+        guidance = self._guidance_cache.get(key)
+        return guidance if guidance is not None else self._build_guidance(key)
+
+    def _build_guidance(self, active_constraints: Tuple[NarrativeConstraint, ...]) -> str:
+        guidance = "\n".join(text for text in (c.get_llm_guidance() for c in active_constraints) if text)
+        self._guidance_cache[active_constraints] = guidance
+        return guidance
 
     @abstractmethod
     async def advance_narrative(self) -> Optional[str]: # Returns content of the activated storylet
@@ -347,8 +1295,84 @@ class NarrativeEngine(ABC):
         3. Activate it (generate content, apply effects).
         4. Update narrative history and flow graph position.
         Returns the presented content or None if no storylet could be activated.
+        While an LLM weighs the candidates, content for the top-ranked storylets is generated
+        speculatively; the prefetches that lose are cancelled.
         """
-        pass
+        eligible = self._find_eligible_storylets()
+        if not eligible:
+            return None
+        active_constraints = self.get_active_constraints()
+        guidance = self.get_constraint_guidance(active_constraints)
+        prefetch: Dict[str, asyncio.Future] = {}
+        if self.llm_interface is not None and self.speculative_prefetch > 0:
+            front_runners = await self.storylet_selector.rank_storylets(
+                eligible, self.game_state, active_constraints, top_k=self.speculative_prefetch,
+                narrative_history=self.narrative_history
+            )
+            prefetch = {
+                s.get_id(): asyncio.ensure_future(
+                    s.generate_content(self.game_state, self.llm_interface, active_constraints, guidance)
+                )
+                for _, s in front_runners
+            }
+        chosen = None
+        try:
+            chosen = await self.storylet_selector.select_next_storylet(
+                eligible, self.game_state, active_constraints, self.narrative_history, self.llm_interface
+            )
+        finally:
+            task = prefetch.pop(chosen.get_id(), None) if chosen is not None else None
+            for loser in prefetch.values():
+                loser.cancel()
+            # Reap the losers so failures from already-finished tasks are retrieved, not logged.
+            await asyncio.gather(*prefetch.values(), return_exceptions=True)
+        if chosen is None:
+            return None
+        if task is not None:
+            content = await task
+        else:
+            content = await chosen.generate_content(self.game_state, self.llm_interface, active_constraints, guidance)
+        self._complete_storylet(chosen)
+        return content
+
+    async def stream_narrative(self) -> AsyncIterator[str]:
+        """
+        Streaming variant of advance_narrative: selects the next storylet and yields its content
+        as it is generated, so time-to-first-token rather than the full generation is the
+        user-visible latency. Effects and history are applied once the stream is exhausted.
+        Closing the iterator early (e.g. a moderation check calling aclose()) abandons the
+        storylet without applying them. Yields nothing if no storylet could be activated.
+        """
+        eligible = self._find_eligible_storylets()
+        if not eligible:
+            return
+        active_constraints = self.get_active_constraints()
+        chosen = await self.storylet_selector.select_next_storylet(
+            eligible, self.game_state, active_constraints, self.narrative_history, self.llm_interface
+        )
+        if chosen is None:
+            return
+        chunks = chosen.stream_content(
+            self.game_state, self.llm_interface, active_constraints, self.get_constraint_guidance(active_constraints)
+        )
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+        self._complete_storylet(chosen)
+
+    def _find_eligible_storylets(self) -> List[SmartStorylet]:
+        current_node = self.get_flow_node_by_id(self.current_flow_node_id) if self.current_flow_node_id else None
+        return self.storylet_selector.find_eligible_storylets(
+            self.all_storylets, self.game_state, current_node, self.precondition_index
+        )
+
+    def _complete_storylet(self, storylet: SmartStorylet) -> None:
+        """Applies an activated storylet's effects, records it in the narrative history and moves along the flow graph."""
+        storylet.apply_effects(self.game_state)
+        self.narrative_history.append(storylet.get_id())
+        self._update_flow_position()
 
     @abstractmethod
     async def trigger_barks(self, event_type: str, event_data: Dict[str, Any]) -> List[str]:
@@ -360,15 +1384,18 @@ class NarrativeEngine(ABC):
 
     @abstractmethod
     def get_storylet_by_id(self, storylet_id: str) -> Optional[SmartStorylet]:
-        return self.all_storylets_map.get(storylet_id)
+        handle = self._id_pool.get(storylet_id)
+        return self.all_storylets_map.get(handle) if handle is not None else None
 
     @abstractmethod
     def get_constraint_by_id(self, constraint_id: str) -> Optional[NarrativeConstraint]:
-        return self.all_constraints_map.get(constraint_id)
+        handle = self._id_pool.get(constraint_id)
+        return self.all_constraints_map.get(handle) if handle is not None else None
 
     @abstractmethod
     def get_flow_node_by_id(self, node_id: str) -> Optional[NarrativeFlowGraphNode]:
-        return self.narrative_flow_graph.get(node_id)
+        handle = self._id_pool.get(node_id)
+        return self._flow_nodes.get(handle) if handle is not None else None
 
 
 # --- Example: Authoring Tool Interface (Conceptual) ---
@@ -409,46 +1436,194 @@ if __name__ == '__main__':
     print("Next steps would be to implement concrete classes for each of these components.")
 
     # Example of how one might think about using these (highly simplified):
+    # Condition keys may carry a comparison suffix, e.g. {"player_health_gt": 50}.
+    _CONDITION_SUFFIXES = {"_ne": COND_NE, "_gt": COND_GT, "_ge": COND_GE, "_lt": COND_LT, "_le": COND_LE}
+
+    def _split_condition_key(key):
+        op_code = _CONDITION_SUFFIXES.get(key[-3:])
+        return (key[:-3], op_code) if op_code is not None else (key, COND_EQ)
+
+    _FORMATTER = string.Formatter()
+
+    def _split_dialogue_template(template):
+        # Returns the format templates before and after the template's single plain {dialogue} field,
+        # or None if the template is malformed, has no such field, or references dialogue more than once.
+        try:
+            parsed = list(_FORMATTER.parse(template))
+        except ValueError:
+            return None
+        pieces, split_at = [], None
+        for literal, field, spec, conversion in parsed:
+            pieces.append(literal.replace("{", "{{").replace("}", "}}"))
+            if field is None:
+                continue
+            if field.startswith("dialogue") and field[len("dialogue"):][:1] in ("", ".", "["):
+                if split_at is not None or field != "dialogue" or spec or conversion:
+                    return None
+                split_at = len(pieces)
+                continue
+            pieces.append("{" + field + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}")
+        if split_at is None:
+            return None
+        return "".join(pieces[:split_at]), "".join(pieces[split_at:])
+
+    class _VariablesView:
+        """Read-only name -> value view over MyGameState's slots, usable with str.format_map without copying."""
+        __slots__ = ("_state",)
+        def __init__(self, state): self._state = state
+        def __getitem__(self, name):
+            value = self._state._vars[self._state._var_name_to_idx[name]] # KeyError for unknown names, as format_map expects
+            if value is _UNSET_SLOT:
+                raise KeyError(name)
+            return value
+
     class MyGameState(GameState):
-        def __init__(self): self._data = {}
-        def get_variable(self, name): return self._data.get(name)
-        def set_variable(self, name, value): self._data[name] = value; print(f"GameState: {name} = {value}")
+        # Variables live in a flat slot list (structure-of-arrays) so compiled conditions can
+        # index them directly.
+        notifies_changes = True
+
+        def __init__(self):
+            super().__init__()
+            self._var_name_to_idx = {}
+            self._vars = []
+            self._variables = _VariablesView(self)
+            # Changes are logged in memory and written out in batches by flush_event_log.
+            self._event_log = deque(maxlen=10000)
+        def _slot(self, name):
+            idx = self._var_name_to_idx.get(name)
+            if idx is None:
+                idx = self._var_name_to_idx[name] = len(self._vars)
+                self._vars.append(_UNSET_SLOT)
+            return idx
+        def get_variable(self, name):
+            idx = self._var_name_to_idx.get(name)
+            value = _UNSET_SLOT if idx is None else self._vars[idx]
+            return None if value is _UNSET_SLOT else value
+        def set_variable(self, name, value):
+            idx = self._slot(name)
+            old_value = self.get_variable(name)
+            self._vars[idx] = value; self._event_log.append((name, value))
+            self._notify_variable_changed(name, old_value, value)
         def check_condition(self, cond):
-            # Simplified: assumes cond is like {"variable_name": "expected_value"}
-            var_name, expected_val = list(cond.items())[0]
-            return self._data.get(var_name) == expected_val
+            # Simplified: cond is like {"variable_name[_op]": "expected_value", ...}; every entry must hold.
+            # Hot-path storylet checks use conditions precompiled by the engine instead.
+            return all(self._check_entry(key, expected_val) for key, expected_val in cond.items())
+        def _check_entry(self, key, expected_val):
+            var_name, op_code = _split_condition_key(key)
+            try:
+                return CONDITION_OPS[op_code](self.get_variable(var_name), expected_val)
+            except TypeError:
+                return False
+        def index_condition(self, cond):
+            if len(cond) != 1: return None
+            key, expected_val = next(iter(cond.items()))
+            return (key, expected_val) if _split_condition_key(key)[1] == COND_EQ else None
+        def compile_condition(self, cond):
+            if len(cond) != 1: return None
+            key, expected_val = next(iter(cond.items()))
+            var_name, op_code = _split_condition_key(key)
+            return (op_code, self._slot(var_name), expected_val)
+        def variable_values(self): return self._vars
+        async def flush_event_log(self, stream=None, interval=0.1):
+            # Run as a background task, e.g. asyncio.create_task(game_state.flush_event_log()).
+            while True:
+                await asyncio.sleep(interval)
+                self.drain_event_log(stream)
+        def drain_event_log(self, stream=None):
+            log = self._event_log
+            if log:
+                lines = []
+                while log:
+                    name, value = log.popleft()
+                    lines.append(f"GameState: {name} = {value}\n")
+                (stream or sys.stdout).write("".join(lines))
         def apply_effect(self, effect):
             # Simplified: assumes effect is like {"variable_name": "new_value"}
             var_name, new_val = list(effect.items())[0]
             self.set_variable(var_name, new_val)
-        def get_context_for_llm(self): return self._data.copy()
+        def apply_effects_batch(self, effects):
+            # Effects are plain assignments, so later effects win and each variable is written once.
+            merged = {}
+            for effect in effects:
+                merged.update(effect)
+            set_variable = self.set_variable
+            for var_name, new_val in merged.items():
+                set_variable(var_name, new_val)
+        def get_context_for_llm(self):
+            # Slots allocated by compile_condition for never-set variables hold _UNSET_SLOT and are omitted.
+            return {name: self._vars[idx] for name, idx in self._var_name_to_idx.items() if self._vars[idx] is not _UNSET_SLOT}
+        def variables_view(self): return self._variables
+
+    # Shared by all storylets so every request starts with the same cacheable prefix.
+    DEFAULT_SYSTEM_PROMPT = "You write short, in-character dialogue for an interactive narrative."
 
     class MyStorylet(SmartStorylet):
-        def __init__(self, storylet_id, preconditions, effects, content_template, llm_prompt=None, fallback="Default content."):
+        __slots__ = ("_preconditions", "_effects", "_content_template", "_llm_prompt_key", "_system_prompt", "_fallback")
+
+        def __init__(self, storylet_id, preconditions, effects, content_template, llm_prompt=None, fallback="Default content.",
+                     system_prompt=DEFAULT_SYSTEM_PROMPT):
             super().__init__(storylet_id)
             self._preconditions = preconditions
             self._effects = effects
             self._content_template = content_template # e.g., "Character {char_name} says: {dialogue}"
             self._llm_prompt_key = llm_prompt # Key in game_state to use for LLM prompt, or direct prompt
+            self._system_prompt = system_prompt
             self._fallback = fallback
 
         def get_id(self): return self.storylet_id
         def get_preconditions(self): return self._preconditions
         def get_effects(self): return self._effects
-        async def generate_content(self, game_state, llm_interface=None, active_constraints=None):
+        async def generate_content(self, game_state, llm_interface=None, active_constraints=None, guidance=None):
             if self._llm_prompt_key and llm_interface:
                 prompt = game_state.get_variable(self._llm_prompt_key) or self._llm_prompt_key
                 try:
                     # Simplified context for LLM
                     llm_context = game_state.get_context_for_llm()
                     llm_context["storylet_id"] = self.storylet_id
-                    generated_dialogue = await llm_interface.generate_text(prompt, llm_context, active_constraints or [])
-                    return self._content_template.format(dialogue=generated_dialogue, **llm_context)
+                    generated_dialogue = await llm_interface.generate_text(
+                        self._system_prompt, prompt, llm_context, active_constraints or [], guidance=guidance
+                    )
+                    return self._content_template.format_map(ChainMap({"dialogue": generated_dialogue}, llm_context))
+                except Exception as e:
+                    print(f"LLM generation failed for {self.storylet_id}: {e}")
+                    return self._fallback.format_map(game_state.variables_view())
+            return self._content_template.format_map(game_state.variables_view()) # Basic template filling, no state copy
+        async def stream_content(self, game_state, llm_interface=None, active_constraints=None, guidance=None):
+            parts = _split_dialogue_template(self._content_template) if self._llm_prompt_key and llm_interface else None
+            if parts is None:
+                yield await self.generate_content(game_state, llm_interface, active_constraints, guidance)
+                return
+            prompt = game_state.get_variable(self._llm_prompt_key) or self._llm_prompt_key
+            llm_context = game_state.get_context_for_llm()
+            llm_context["storylet_id"] = self.storylet_id
+            try:
+                # Fill the surrounding text up front so template errors fall back before anything is emitted.
+                head, tail = (part.format_map(ChainMap({"dialogue": ""}, llm_context)) for part in parts)
+            except Exception as e:
+                print(f"LLM generation failed for {self.storylet_id}: {e}")
+                yield self._fallback.format_map(game_state.variables_view())
+                return
+            chunks = llm_interface.stream_text(
+                self._system_prompt, prompt, llm_context, active_constraints or [], guidance=guidance
+            )
+            try:
+                # Wait for the first token before emitting anything, so a failed request can still fall back.
+                try:
+                    first = await anext(chunks, "")
                 except Exception as e:
                     print(f"LLM generation failed for {self.storylet_id}: {e}")
-                    return self._fallback.format(**game_state.get_context_for_llm())
-            return self._content_template.format(**game_state.get_context_for_llm()) # Basic template filling
-        def get_llm_directives(self): return {"prompt_key": self._llm_prompt_key} if self._llm_prompt_key else None
+                    yield self._fallback.format_map(game_state.variables_view())
+                    return
+                yield head + first
+                async for chunk in chunks:
+                    yield chunk
+                yield tail
+            finally:
+                await chunks.aclose()
+        def get_llm_directives(self):
+            if not self._llm_prompt_key:
+                return None
+            return {"prompt_key": self._llm_prompt_key, "system_template": self._system_prompt}
         def get_fallback_content(self): return self._fallback
         def get_metadata(self): return {"type": "dialogue"} # Example
 